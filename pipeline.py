@@ -6,24 +6,270 @@ Version: 0.0.1
 License: MIT
 Description:
     This pipeline give the agentic power to the model deepseek r1 reasoning model.
-Requirements: openai==1.60.0, pydantic==2.10.5, duckduckgo_search==7.2.1, beautifulsoup4==4.12.3, typing-extensions==4.12.2
+Requirements: openai==1.60.0, pydantic==2.10.5, duckduckgo_search==7.2.1, selectolax==0.3.27, lxml==5.3.0, httpx[http2]==0.28.1, orjson==3.10.15, cachetools==5.5.1, typing-extensions==4.12.2
 """
 
-from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Union, Generator, Iterator, Optional
+from pydantic import BaseModel, Field, ConfigDict, TypeAdapter
+from typing import Dict, List, Union, Generator, Iterator, Optional
 from enum import Enum
+from dataclasses import dataclass
 from datetime import datetime
-from openai import OpenAI
+from openai import AsyncOpenAI
 from duckduckgo_search import DDGS
+from cachetools import TTLCache
+import asyncio
+import concurrent.futures
+import threading
+import hashlib
+import sqlite3
+import time
 import os
-import json
-import urllib
-from bs4 import BeautifulSoup
-import subprocess
+import orjson
+import re
+import httpx
+import lxml.html
+import sys
 import logging
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from selectolax.parser import HTMLParser
+except ImportError:
+    HTMLParser = None
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
 logger = logging.getLogger(__name__)
 
+# Reads one JSON request per stdin line and answers with one JSON line. Every snippet
+# runs in a child forked from this warm interpreter, in its own process group, with its
+# stdout and stderr file descriptors pointed at temporary files, so nothing a snippet
+# changes (builtins, modules, environment, cwd, threads) outlives it, and output of the
+# processes it spawns is captured too. Fds 0 and 1 are moved away from the protocol pipes.
+_PYTHON_WORKER = r"""
+import json, os, signal, sys, tempfile, time, traceback
+
+requests = os.fdopen(os.dup(0), "r")
+responses = os.fdopen(os.dup(1), "w")
+os.dup2(os.open(os.devnull, os.O_RDWR), 0)
+os.dup2(os.open(os.devnull, os.O_RDWR), 1)
+OUTPUT_LIMIT = 1 << 22
+
+
+def run(code, stdout, stderr):
+    returncode = 1
+    try:
+        os.setpgid(0, 0)
+        os.close(requests.fileno())
+        os.close(responses.fileno())
+        os.dup2(stdout, 1)
+        os.dup2(stderr, 2)
+        sys.stdin = open(os.devnull)
+        sys.stdout = open(1, "w", buffering=1, closefd=False)
+        sys.stderr = open(2, "w", buffering=1, closefd=False)
+        try:
+            exec(compile(code, "<code_executer>", "exec"), {"__name__": "__main__"})
+            returncode = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                returncode = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+        except BaseException as e:
+            # skip this frame, so the traceback starts at the snippet
+            traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(returncode & 0xFF)
+
+
+for line in requests:
+    request = json.loads(line)
+    with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+        pid = os.fork()
+        if pid == 0:
+            run(request["code"], stdout.fileno(), stderr.fileno())
+
+        deadline = time.monotonic() + request["timeout"]
+        delay = 0.001
+        timed_out = False
+        while True:
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done:
+                break
+            if time.monotonic() >= deadline:
+                timed_out = True
+                os.killpg(pid, signal.SIGKILL)
+                _, status = os.waitpid(pid, 0)
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, 0.02)
+        # reap whatever the snippet left running in its process group
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+        outputs = []
+        for stream in (stdout, stderr):
+            stream.seek(0)
+            outputs.append(stream.read(OUTPUT_LIMIT).decode(errors="replace"))
+
+    responses.write(json.dumps({
+        "stdout": outputs[0],
+        "stderr": outputs[1],
+        "returncode": os.waitstatus_to_exitcode(status),
+        "timed_out": timed_out,
+    }) + "\n")
+    responses.flush()
+"""
+
+_TAG_RE = re.compile(
+    r"<(internet_search|code_executer|scraping|final_answer)>(.*?)</\1>",
+    re.DOTALL,
+)
+
+# Scraped pages by URL: (fresh until, etag, last modified, text). Entries are kept
+# for an hour so stale pages can still be revalidated with a conditional GET.
+_SCRAPE_CACHE = TTLCache(maxsize=512, ttl=3600)
+# Extracted text by sha256 of the page HTML, so unchanged pages are never parsed twice.
+_SCRAPE_TEXT_CACHE = TTLCache(maxsize=512, ttl=3600)
+# Seconds a scraped page is served without asking the server again.
+_SCRAPE_FRESHNESS = 300
+
+# Matches a complete tool result message, e.g. <scraping.result>...</scraping.result>
+# or <code_executer.result returncode=0>...</code_executer.result>.
+_RESULT_RE = re.compile(r"<(\w+)\.result(?: returncode=-?\d+)?>(.*)</\1\.result>", re.DOTALL)
+
+class _ResponseCache:
+    """
+    SQLite backed cache of reasoner responses keyed by the exact request messages.
+
+    Optionally keeps an in-memory matrix of normalized embeddings of opening user
+    questions, bounded to the most recent max_embeddings, so a semantically similar
+    question can reuse a cached response.
+    """
+
+    def __init__(self, path: str = ":memory:", ttl: int = 1800, max_embeddings: int = 1024):
+        self.ttl = ttl
+        self.max_embeddings = max_embeddings
+        self._lock = threading.Lock()
+        # Lock of each key being computed and the number of requests using it.
+        self._pending: Dict[str, list] = {}
+        self._keys: List[str] = []
+        self._embeddings = None
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        # ts holds the expiration timestamp of the entry.
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, payload BLOB, ts INTEGER)"
+        )
+
+    @staticmethod
+    def key(messages: List[dict]) -> str:
+        """
+        Computes a deterministic cache key for the given messages. The "Now is:"
+        clock message is rounded to the date, otherwise no two requests would match.
+        """
+        messages = [
+            {**message, "content": message["content"][:len("Now is: YYYY-MM-DD")]}
+            if message["role"] == "system" and str(message["content"]).startswith("Now is:")
+            else message
+            for message in messages
+        ]
+        payload = orjson.dumps(
+            {"model": "deepseek-reasoner", "messages": messages},
+            option=orjson.OPT_SORT_KEYS,
+        )
+        return hashlib.sha256(payload).hexdigest()
+
+    def pending(self, key: str) -> asyncio.Lock:
+        """
+        Returns the lock guarding the computation of the given key, so concurrent
+        identical requests wait for the first one instead of calling the model again.
+        Every call must be paired with a release of the same key.
+        """
+        entry = self._pending.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, key: str):
+        """
+        Drops the lock of the given key once no request holds or waits for it.
+        """
+        entry = self._pending[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._pending[key]
+
+    def get(self, key: str) -> Optional[dict]:
+        """
+        Returns the cached payload for the key, or None if missing or expired.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT payload, ts FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return orjson.loads(row[0])
+
+    def set(self, key: str, payload: dict, ttl: Optional[int] = None):
+        """
+        Stores the payload for the key during ttl seconds, purging expired entries.
+        """
+        now = time.time()
+        expires = int(now + (ttl if ttl is not None else self.ttl))
+        with self._lock:
+            self._connection.execute("DELETE FROM responses WHERE ts < ?", (now,))
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, payload, ts) VALUES (?, ?, ?)",
+                (key, orjson.dumps(payload), expires),
+            )
+            self._connection.commit()
+
+    def nearest(self, embedding: List[float], threshold: float) -> Optional[str]:
+        """
+        Returns the key whose embedding has a cosine similarity above the threshold.
+        """
+        if np is None or self._embeddings is None:
+            return None
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        with self._lock:
+            scores = self._embeddings @ query
+            index = int(np.argmax(scores))
+            if scores[index] > threshold:
+                return self._keys[index]
+        return None
+
+    def remember(self, key: str, embedding: List[float]):
+        """
+        Indexes the embedding of the opening question of the given key, evicting
+        the oldest embeddings beyond max_embeddings.
+        """
+        if np is None:
+            return
+        row = np.asarray(embedding, dtype=np.float32)
+        row /= np.linalg.norm(row) or 1.0
+        with self._lock:
+            if self._embeddings is None:
+                self._embeddings = row[np.newaxis, :]
+            else:
+                self._embeddings = np.vstack([self._embeddings, row])[-self.max_embeddings:]
+            self._keys = (self._keys + [key])[-self.max_embeddings:]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
 class Pipeline:
     class TextWebSearchRequest(BaseModel):
         """
@@ -60,11 +306,13 @@ class Pipeline:
 
     class WebSiteContent(BaseModel):
         """
-        Model representing a website content.
+        Model representing the content of one or more websites.
         """
-        url: str = Field(
+        urls: List[str] = Field(
             ...,
-            description="URL of the website."
+            min_length=1,
+            max_length=10,
+            description="URLs of the websites. Request every website you need at once, up to 10."
         )
 
         model_config = ConfigDict(
@@ -89,6 +337,25 @@ class Pipeline:
             strict=True,
         )
 
+    @dataclass(slots=True, frozen=True)
+    class ExecResult:
+        """
+        Result of a code execution.
+        """
+        stdout: str
+        stderr: str
+        returncode: int
+
+        @property
+        def output(self) -> str:
+            """
+            The standard output on success; on failure both streams, the standard
+            output first, so whatever was printed before the error is kept.
+            """
+            if self.returncode != 0:
+                return "\n".join(filter(None, (self.stdout, self.stderr)))
+            return self.stdout or self.stderr
+
     class State(str, Enum):
         """
         Enum for the state of the pipeline.
@@ -115,19 +382,31 @@ class Pipeline:
             "name": "Internet Search",
             "description": "Search the internet for the answer to the question.",
             "function": "internet_search",
-            "input_description": TextWebSearchRequest.schema_json(),
+            "input_description": orjson.dumps(TextWebSearchRequest.model_json_schema(), option=orjson.OPT_SORT_KEYS).decode(),
+            "model": TextWebSearchRequest,
+            "executor": "execute_text_web_search_tool",
+            "label": "text web search",
+            "memoize": True,
         },
         "CODE_EXECUTER": {
             "name": "Code Executer",
             "description": "Execute code and return the result.",
             "function": "code_executer",
-            "input_description": CodeExecution.schema_json(),
+            "input_description": orjson.dumps(CodeExecution.model_json_schema(), option=orjson.OPT_SORT_KEYS).decode(),
+            "model": CodeExecution,
+            "executor": "execute_python_code",
+            "label": "code executer",
+            "memoize": False,
         },
         "SCRAPING": {
             "name": "Website Scraping",
-            "description": "Scrape a specific website and return the content. If you need more information about the website, you must use the scraping tool.",
+            "description": "Scrape one or more websites and return their content. If you need more information about the websites, you must use the scraping tool. Batch every URL you need in a single tag.",
             "function": "scraping",
-            "input_description": WebSiteContent.schema_json(),
+            "input_description": orjson.dumps(WebSiteContent.model_json_schema(), option=orjson.OPT_SORT_KEYS).decode(),
+            "model": WebSiteContent,
+            "executor": "execute_web_site_content_tool",
+            "label": "scraping",
+            "memoize": False,
         },
         "FINAL_ANSWER": {
             "name": "Final Answer",
@@ -155,14 +434,13 @@ class Pipeline:
         Generate a tag from a tools dictionary
         Tag must start <function>{input_description}</function>
         """
-        return "\n".join([cls.tag_generator(dict) for dict in dict.values()])
+        return "\n".join([cls.tag_generator(tool) for tool in dict.values()])
 
-    @classmethod
-    def execute_text_web_search_tool(cls, text_web_search: TextWebSearchRequest) -> str:
+    def execute_text_web_search_tool(self, text_web_search: TextWebSearchRequest) -> str:
         """
         Executes the text web search tool with the given parameters.
         """
-        results = DDGS().text(
+        results = self._ddgs.text(
             keywords=text_web_search.keywords,
             region=text_web_search.region,
             safesearch=text_web_search.safesearch,
@@ -171,84 +449,211 @@ class Pipeline:
             max_results=text_web_search.max_results,
         )
 
-        result = json.dumps(results, indent=0)
+        result = orjson.dumps(results).decode()
         return result
 
     @classmethod
-    def execute_web_site_content_tool(cls, web_site_content: WebSiteContent) -> str:
+    def html_to_text(cls, html: bytes) -> str:
+        """
+        Extracts the text of an HTML document without scripts and styles, one
+        phrase per line. Uses selectolax when installed, falling back to lxml.
+        """
+        if HTMLParser is None:
+            document = lxml.html.fromstring(html)
+            for element in document.xpath("//script|//style|//noscript"):
+                element.drop_tree()
+            text = document.text_content()
+        else:
+            tree = HTMLParser(html)
+            tree.strip_tags(["script", "style", "noscript"])
+            node = tree.body or tree.root
+            text = node.text(separator="\n") if node is not None else ""
+
+        # break multi-headlines into a line each, strip every line and drop blank ones,
+        # all through C level string methods instead of nested generators
+        return "\n".join(filter(None, map(str.strip, text.replace("  ", "\n").splitlines())))
+
+    async def fetch_web_site_content(self, url: str) -> str:
         """
-        Executes the web site content tool with the given parameters.
+        Fetches the given URL and returns its text content.
         """
         logger.info(
-            "(execute_web_site_content_tool) Getting content from URL: %s", web_site_content.url
+            "(fetch_web_site_content) Getting content from URL: %s", url
         )
+        # concurrent requests for the same URL wait for the first one
+        entry = self._scrape_locks.setdefault(url, [asyncio.Lock(), 0])
+        entry[1] += 1
         try:
-            html = urllib.urlopen(web_site_content.url).read()
-            soup = BeautifulSoup(html)
-
-            # kill all script and style elements
-            for script in soup(["script", "style"]):
-                script.extract()    # rip it out
-
-            # get text
-            text = soup.get_text()
-
-            # break into lines and remove leading and trailing space on each
-            lines = (line.strip() for line in text.splitlines())
-            # break multi-headlines into a line each
-            chunks = (phrase.strip()
-                        for line in lines for phrase in line.split("  "))
-            # drop blank lines
-            text = '\n'.join(chunk for chunk in chunks if chunk)
+            async with entry[0]:
+                cached = _SCRAPE_CACHE.get(url)
+                if cached is not None and cached[0] > time.time():
+                    logger.info(
+                        "(fetch_web_site_content) Web site content served from cache for URL: %s", url
+                    )
+                    return cached[3]
+
+                headers = {}
+                if cached is not None and cached[1]:
+                    headers["If-None-Match"] = cached[1]
+                if cached is not None and cached[2]:
+                    headers["If-Modified-Since"] = cached[2]
+                response = await self._http.get(url, headers=headers)
+
+                if response.status_code == 304 and cached is not None:
+                    text = cached[3]
+                else:
+                    response.raise_for_status()
+
+                    # get text
+                    digest = hashlib.sha256(response.content).hexdigest()
+                    text = _SCRAPE_TEXT_CACHE.get(digest)
+                    if text is None:
+                        text = await self.run_blocking(self.html_to_text, response.content)
+                        _SCRAPE_TEXT_CACHE[digest] = text
+
+                _SCRAPE_CACHE[url] = (
+                    time.time() + _SCRAPE_FRESHNESS,
+                    response.headers.get("ETag") or (cached[1] if cached else None),
+                    response.headers.get("Last-Modified") or (cached[2] if cached else None),
+                    text,
+                )
             logger.debug(
-                "(execute_web_site_content_tool) Web site content: %s", text
+                "(fetch_web_site_content) Web site content: %s", text
             )
             logger.info(
-                "(execute_web_site_content_tool) Web site content complete for URL: %s", web_site_content.url
+                "(fetch_web_site_content) Web site content complete for URL: %s", url
             )
             return text
         except Exception as e:
             logger.exception(
-                "(execute_web_site_content_tool) Web site content failed for URL: %s", web_site_content.url
+                "(fetch_web_site_content) Web site content failed for URL: %s", url
             )
             return str(e)
+        finally:
+            # a woken waiter may not hold the lock yet, so only the last user drops it
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._scrape_locks[url]
 
-    @classmethod
-    def execute_python_code(cls, code: CodeExecution) -> (str, int):
+    async def execute_web_site_content_tool(self, web_site_content: WebSiteContent) -> str:
+        """
+        Executes the web site content tool, fetching every URL concurrently.
+        """
+        async def fetch(url: str) -> str:
+            async with self._scrape_semaphore:
+                return await self.fetch_web_site_content(url)
+
+        results = await asyncio.gather(
+            *[fetch(url) for url in web_site_content.urls],
+            return_exceptions=True,
+        )
+        return "\n\n---\n\n".join(
+            f"URL: {url}\n{result}" for url, result in zip(web_site_content.urls, results)
+        )
+
+    async def start_python_worker(self) -> asyncio.subprocess.Process:
+        """
+        Starts a long-lived Python worker that executes code snippets.
         """
-        Executes the given Python code and returns the output and return code.
+        return await asyncio.create_subprocess_exec(
+            sys.executable, "-u", "-c", _PYTHON_WORKER,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            limit=2 ** 24,
+        )
+
+    async def stop_python_worker(self, worker: Optional[asyncio.subprocess.Process]):
+        """
+        Kills the given Python worker.
+        """
+        if worker is not None and worker.returncode is None:
+            worker.kill()
+            await worker.wait()
+
+    async def start_python_workers(self):
+        """
+        Fills the pool of Python workers, so snippets of different sessions run in parallel.
+        """
+        self._python_workers = asyncio.Queue()
+        for _ in range(self.valves.CODE_EXECUTION_WORKERS):
+            self._python_workers.put_nowait(await self.start_python_worker())
+
+    async def stop_python_workers(self):
+        """
+        Kills the idle Python workers of the pool.
+        """
+        while not self._python_workers.empty():
+            await self.stop_python_worker(self._python_workers.get_nowait())
+
+    async def execute_python_code(self, code: CodeExecution) -> ExecResult:
+        """
+        Executes the given Python code in a child of a pooled Python worker.
 
         Args:
-            code (str): The Python code to execute.
+            code (CodeExecution): The Python code to execute.
 
         Returns:
-            Tuple[str, int]: A tuple containing the combined output and the return code.
+            ExecResult: The stripped standard output, error output and return code.
         """
+        timeout = self.valves.CODE_EXECUTION_TIMEOUT
+        worker = await self._python_workers.get()
         try:
-            result = subprocess.run(
-                ["python", "-c", code.code],
-                capture_output=True,
-                text=True,
-                check=True,
-            )
-            stdout = result.stdout.strip()
-            stderr = result.stderr.strip()
+            if worker is None or worker.returncode is not None:
+                worker = await self.start_python_worker()
 
-            # if fails, return the error message
-            if result.returncode != 0:
-                return stderr
+            worker.stdin.write(orjson.dumps({"code": code.code, "timeout": timeout}) + b"\n")
+            await worker.stdin.drain()
+            # the worker enforces the timeout itself, this only guards against a stuck worker
+            line = await asyncio.wait_for(worker.stdout.readline(), timeout=timeout + 10)
+            if not line:
+                raise RuntimeError("The Python worker exited unexpectedly.")
+            result = orjson.loads(line)
+        except asyncio.TimeoutError:
+            await self.stop_python_worker(worker)
+            worker = None
+            return self.ExecResult(
+                stdout="",
+                stderr=f"Code execution timed out after {timeout} seconds.",
+                returncode=-1,
+            )
+        except Exception as e:
+            await self.stop_python_worker(worker)
+            worker = None
+            return self.ExecResult(stdout="", stderr=str(e), returncode=-1)
+        finally:
+            self._python_workers.put_nowait(worker)
 
-            return stdout
-        except subprocess.CalledProcessError as e:
-            stderr = e.stderr.strip()
+        if result["timed_out"]:
+            return self.ExecResult(
+                stdout=result["stdout"].strip(),
+                stderr="\n".join(filter(None, (
+                    result["stderr"].strip(),
+                    f"Code execution timed out after {timeout} seconds.",
+                ))),
+                returncode=-1,
+            )
 
-            return stderr
-        except Exception as e:
-            return str(e)
+        return self.ExecResult(
+            stdout=result["stdout"].strip(),
+            stderr=result["stderr"].strip(),
+            returncode=result["returncode"],
+        )
 
     class Valves(BaseModel):
         DEEPSEEK_API_KEY: str = ""
         BASE_URL: str = "https://api.deepseek.com"
+        RESPONSE_CACHE_PATH: str = ":memory:"
+        RESPONSE_CACHE_TTL: int = 1800
+        SEMANTIC_CACHE_MODEL: str = ""
+        SEMANTIC_CACHE_THRESHOLD: float = 0.90
+        # DeepSeek serves no embeddings, the semantic cache needs a provider that does.
+        EMBEDDING_API_KEY: str = ""
+        EMBEDDING_BASE_URL: str = "https://api.openai.com/v1"
+        CODE_EXECUTION_TIMEOUT: int = 30
+        CODE_EXECUTION_WORKERS: int = 4
+        MAX_PROMPT_TOKENS: int = 48000
+        MAX_DEPTH: int = 5
         pass
 
     def __init__(self):
@@ -256,7 +661,11 @@ class Pipeline:
         self.valves = self.Valves(
             **{
                 "DEEPSEEK_API_KEY": os.getenv("DEEPSEEK_API_KEY", "your-deepseek-api-key-here"),
-                "BASE_URL": os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
+                "BASE_URL": os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com"),
+                "RESPONSE_CACHE_PATH": os.getenv("RESPONSE_CACHE_PATH", ":memory:"),
+                "SEMANTIC_CACHE_MODEL": os.getenv("SEMANTIC_CACHE_MODEL", ""),
+                "EMBEDDING_API_KEY": os.getenv("EMBEDDING_API_KEY", ""),
+                "EMBEDDING_BASE_URL": os.getenv("EMBEDDING_BASE_URL", "https://api.openai.com/v1"),
             }
         )
         pass
@@ -264,153 +673,450 @@ class Pipeline:
     async def on_startup(self):
         # This function is called when the server is started.
         print(f"on_startup:{__name__}")
-        self.client = OpenAI(
+        self.client = AsyncOpenAI(
             api_key=self.valves.DEEPSEEK_API_KEY,
             base_url=self.valves.BASE_URL
         )
+        self.embedding_client = AsyncOpenAI(
+            api_key=self.valves.EMBEDDING_API_KEY,
+            base_url=self.valves.EMBEDDING_BASE_URL
+        )
+        # Reused by every tool call to keep connections (and the DDGS session) warm.
+        self._ddgs = DDGS()
+        self._http = httpx.AsyncClient(
+            http2=True,
+            timeout=10,
+            follow_redirects=True,
+            headers={"User-Agent": "Mozilla/5.0 (compatible; r1-pipeline/0.0.1)"},
+        )
+        # Per-URL lock and the number of fetches holding or waiting for it.
+        self._scrape_locks: Dict[str, list] = {}
+        # Shared by every session, so blocking tool I/O never spawns unbounded threads.
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=16,
+            thread_name_prefix="r1-pipeline-tool",
+        )
+        self.response_cache = _ResponseCache(
+            self.valves.RESPONSE_CACHE_PATH,
+            self.valves.RESPONSE_CACHE_TTL,
+        )
+        # pipe() is called synchronously by the server, so the state machine runs
+        # on a dedicated event loop that keeps the client connections alive between calls.
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(
+            target=self._loop.run_forever,
+            name="r1-pipeline-loop",
+            daemon=True,
+        )
+        self._loop_thread.start()
+        # Shared by every session to be polite with the scraped hosts; asyncio
+        # primitives bind to the loop they are first used on, the pipeline loop.
+        self._scrape_semaphore = asyncio.Semaphore(5)
+        self._encoding = tiktoken.get_encoding("cl100k_base") if tiktoken is not None else None
+        # Snippets are forked from warm interpreters instead of paying a startup on every execution.
+        await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(self.start_python_workers(), self._loop)
+        )
         pass
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
         print(f"on_shutdown:{__name__}")
+        for close in (self.client.close, self.embedding_client.close, self._http.aclose, self.stop_python_workers):
+            await asyncio.wrap_future(
+                asyncio.run_coroutine_threadsafe(close(), self._loop)
+            )
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._loop.close()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self.response_cache.close()
         pass
 
-    def calculate_state(self, assistant_message: str) -> StateResult:
+    def run_coroutine(self, coroutine):
+        """
+        Runs the given coroutine on the pipeline event loop and waits for its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    async def run_blocking(self, function, *args):
+        """
+        Runs a blocking tool function on the shared thread pool.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._pool, function, *args)
+
+    async def calculate_state(
+        self, assistant_message: str, tool_results: Optional[Dict[str, StateResult]] = None
+    ) -> StateResult:
         # This function is called when the server is started.
         print(f"calculate_state:{__name__}")
 
-        # Check if the assistant message contains the tag for the Internet Search tool.
-        if "<internet_search>" in assistant_message:
-            try:
-                # extract content between <internet_search> and </internet_search>
-                content = assistant_message.split("<internet_search>")[1].split("</internet_search>")[0]
-                text_web_search = self.TextWebSearchRequest(**json.loads(content))
-
-                if text_web_search.keywords == None or text_web_search.keywords == "":
-                    return self.StateResult(
-                        state=self.State.NEXT_STEP,
-                        message="Please provide the keywords for the search."
-                    )
+        # Find the first complete tool tag in a single scan of the message.
+        match = _TAG_RE.search(assistant_message)
+        if match is None:
+            return self.StateResult(
+                state=self.State.ERROR,
+                message="No valid tool tag found. Your output MUST be only one of the available tool tags."
+            )
 
-                # Execute the text web search tool.
-                result = self.execute_text_web_search_tool(text_web_search)
-                # Return the result as a message.
-                return self.StateResult(
-                    state=self.State.NEXT_STEP,
-                    message=f"<internet_search.result>{result}</internet_search.result>"  
-                )
-            except Exception as e:
-                return self.StateResult(
-                    state=self.State.ERROR,
-                    message=f"Error parsing the text web search request: {e}"
-                ) 
-        
-        if "<code_executer>" in assistant_message:
-            try:
-                # extract content between <code_executer> and </code_executer>
-                content = assistant_message.split("<code_executer>")[1].split("</code_executer>")[0]
-                code_execution = self.CodeExecution(**json.loads(content))
-                result = self.execute_python_code(code_execution)
-                # Return the result as a message.
-                return self.StateResult(
-                    state=self.State.NEXT_STEP,
-                    message=f"<code_executer.result>{result}</code_executer.result>"
-                )
-            except Exception as e:
-                return self.StateResult(
-                    state=self.State.ERROR,
-                    message=f"Error parsing the code executer request: {e}"
-                )
+        tag, content = match.group(1), match.group(2)
+        if tag == "final_answer":
+            return self.StateResult(
+                state=self.State.FINISHED,
+                message=content
+            )
+
+        adapter, function_name, result_tag, label, memoize = _DISPATCH[tag]
+
+        # An identical search in the same session reuses its full result; code
+        # runs again on purpose and pages are already cached per URL.
+        if not memoize:
+            tool_results = None
+        call = hashlib.sha256(match.group(0).encode()).hexdigest()
+        if tool_results is not None and call in tool_results:
+            return tool_results[call]
+
+        try:
+            # validated straight from the JSON text, without an intermediate dict
+            request = adapter.validate_json(content)
 
-        if "<scraping>" in assistant_message:
-            try:
-                # extract content between <scraping> and </scraping>
-                content = assistant_message.split("<scraping>")[1].split("</scraping>")[0]
-                web_site_content = self.WebSiteContent(**json.loads(content))
-                result = self.execute_web_site_content_tool(web_site_content)
-                # Return the result as a message.
+            if isinstance(request, self.TextWebSearchRequest) and not request.keywords:
                 return self.StateResult(
                     state=self.State.NEXT_STEP,
-                    message=f"<scraping.result>{result}</scraping.result>"
-                )
-            except Exception as e:
-                return self.StateResult(
-                    state=self.State.ERROR,
-                    message=f"Error parsing the scraping request: {e}"
-                )
-        if "<final_answer>" in assistant_message:
-            try:
-                # extract content between <final_answer> and </final_answer>
-                content = assistant_message.split("<final_answer>")[1].split("</final_answer>")[0]
-                # Return the result as a message.
-                return self.StateResult(
-                    state=self.State.FINISHED,
-                    message=content
-                )
-            except Exception as e:
-                return self.StateResult(
-                    state=self.State.ERROR,
-                    message=f"Error parsing the final answer request: {e}"
+                    message="Please provide the keywords for the search."
                 )
 
-    def process_state(self, messages: List[dict], max_depth: int = 5) -> str:
-        """Recursively process state transitions and messages."""
-        if max_depth <= 0:
-            return "Max recursion depth exceeded"
+            function = getattr(self, function_name)
+            if asyncio.iscoroutinefunction(function):
+                result = await function(request)
+            else:
+                result = await self.run_blocking(function, request)
+            # Return the result as a message.
+            if isinstance(result, self.ExecResult):
+                message = f"<{result_tag} returncode={result.returncode}>{result.output}</{result_tag}>"
+            else:
+                message = f"<{result_tag}>{result}</{result_tag}>"
+            state_result = self.StateResult(
+                state=self.State.NEXT_STEP,
+                message=message
+            )
+            if tool_results is not None:
+                tool_results[call] = state_result
+            return state_result
+        except Exception as e:
+            return self.StateResult(
+                state=self.State.ERROR,
+                message=f"Error parsing the {label} request: {e}"
+            )
+
+    def count_tokens(self, text: str) -> int:
+        """
+        Counts the tokens of the text, estimating 4 characters per token without tiktoken.
+        """
+        if self._encoding is None:
+            return len(text) // 4
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    @classmethod
+    def summarize_tool_result(cls, content: str) -> str:
+        """
+        Replaces a full tool result by its hash and the beginning of its payload.
+        """
+        match = _RESULT_RE.fullmatch(content)
+        tag, payload = match.group(1), match.group(2)
+        digest = hashlib.sha256(payload.encode()).hexdigest()[:16]
+        summary = " ".join(payload[:200].split())
+        return f'<{tag}.result hash="{digest}" truncated="true">{summary}...</{tag}.result>'
+
+    def truncate_tool_result(self, content: str, tokens: int) -> str:
+        """
+        Cuts the payload of a full tool result down to about the given number of tokens.
+        """
+        match = _RESULT_RE.fullmatch(content)
+        tag, payload = match.group(1), match.group(2)
+        # leave room for the wrapping tags and the truncation notice
+        tokens = max(tokens - 32, 0)
+        if self._encoding is None:
+            payload = payload[:tokens * 4]
+        else:
+            payload = self._encoding.decode(
+                self._encoding.encode(payload, disallowed_special=())[:tokens]
+            )
+        return (
+            f'<{tag}.result truncated="true">{payload}\n'
+            f"[... truncated to fit the prompt budget]</{tag}.result>"
+        )
+
+    def compact_messages(self, messages: List[dict], question: int) -> List[dict]:
+        """
+        Builds the messages sent to the reasoner: tool results older than the latest
+        one are summarized. While the prompt is above MAX_PROMPT_TOKENS, the oldest
+        turns are dropped only if it would not fit with the latest tool result cut to
+        a quarter of the budget, then the latest result is cut to fit. The system
+        messages, the user question at index question and the latest tool call and
+        result are always kept. The given history is left untouched.
+        """
+        budget = self.valves.MAX_PROMPT_TOKENS
+        results = [
+            index for index, message in enumerate(messages)
+            if message["role"] == "user" and _RESULT_RE.fullmatch(message["content"])
+        ]
+        compacted = list(messages)
+        for index in results[:-1]:
+            compacted[index] = {
+                "role": "user",
+                "content": self.summarize_tool_result(messages[index]["content"]),
+            }
+
+        tokens = [self.count_tokens(message["content"]) for message in compacted]
+        latest = results[-1] if results and results[-1] > question else None
+
+        # Earlier turns are only dropped if the prompt is still too large with the latest
+        # result cut down to a quarter of the budget, so a large result is cut first.
+        if latest is not None:
+            latest_tokens = tokens[latest]
+            tokens[latest] = min(latest_tokens, budget // 4)
+
+        # Drop groups, oldest first: the earlier conversation, one user turn and its
+        # replies at a time, then the earlier tool steps as assistant call/result pairs.
+        head = next(
+            (index for index, message in enumerate(compacted) if message["role"] != "system"),
+            len(compacted),
+        )
+        groups = []
+        for index in range(head, question):
+            if not groups or compacted[index]["role"] == "user":
+                groups.append([])
+            groups[-1].append(index)
+        last_step = latest - 1 if latest is not None else len(compacted) - 2
+        groups += [[index, index + 1] for index in range(question + 1, last_step - 1, 2)]
+
+        dropped = set()
+        for group in groups:
+            if sum(tokens) <= budget:
+                break
+            dropped.update(group)
+            for index in group:
+                tokens[index] = 0
+
+        # Whatever is still over the budget comes out of the latest result.
+        if latest is not None:
+            tokens[latest] = latest_tokens
+            overflow = sum(tokens) - budget
+            if overflow > 0:
+                compacted[latest] = {
+                    "role": "user",
+                    "content": self.truncate_tool_result(
+                        messages[latest]["content"], latest_tokens - overflow
+                    ),
+                }
+                tokens[latest] = self.count_tokens(compacted[latest]["content"])
+        if sum(tokens) > budget:
+            logger.warning(
+                "(compact_messages) Prompt still above the %s tokens budget: %s", budget, sum(tokens)
+            )
+
+        return [message for index, message in enumerate(compacted) if index not in dropped]
+
+    async def embed_last_user_turn(self, messages: List[dict]) -> Optional[List[float]]:
+        """
+        Embeds the user question for the semantic cache, if it is enabled. Only an
+        opening question is embedded (no assistant turn, and any repeated user turn
+        is the same question), since an answer that depends on earlier history must
+        never be served to another conversation.
+        """
+        if not self.valves.SEMANTIC_CACHE_MODEL or np is None:
+            return None
+        user_turns = [message for message in messages if message["role"] == "user"]
+        if (
+            not user_turns
+            or any(message["role"] == "assistant" for message in messages)
+            or any(message["content"] != user_turns[0]["content"] for message in user_turns)
+        ):
+            return None
+        try:
+            response = await self.embedding_client.embeddings.create(
+                model=self.valves.SEMANTIC_CACHE_MODEL,
+                input=user_turns[-1]["content"],
+            )
+            return response.data[0].embedding
+        except Exception:
+            logger.exception("(embed_last_user_turn) Embedding failed, skipping semantic cache")
+            return None
+
+    async def stream_completion(self, messages: List[dict]) -> dict:
+        """
+        Streams the reasoner response and stops reading as soon as a complete tool
+        tag has been emitted, so the tool can run while the model is still talking.
 
-        response = self.client.chat.completions.create(
+        Returns:
+            dict: The assistant "content" and "reasoning_content".
+        """
+        stream = await self.client.chat.completions.create(
             model="deepseek-reasoner",
             messages=messages,
-            stream=False
+            stream=True,
+            stream_options={"include_usage": True},
         )
+        content = []
+        reasoning_content = []
+        usage = None
+        cut = False
+        try:
+            async for chunk in stream:
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                reasoning_delta = getattr(delta, "reasoning_content", None)
+                if reasoning_delta:
+                    reasoning_content.append(reasoning_delta)
+                if delta.content:
+                    content.append(delta.content)
+                    # A tag can only be completed by a chunk containing its closing ">".
+                    if ">" in delta.content and _TAG_RE.search("".join(content)):
+                        cut = True
+                        break
+        finally:
+            await stream.close()
 
-        assistant_message = response.choices[0].message.content
-        reasoning_content = response.choices[0].message.reasoning_content
+        # Only reported when the stream ended on its own, a cut stream is not
+        # read further just for its usage.
+        if usage is not None and not cut:
+            logger.info(
+                "(stream_completion) Prompt cache hit tokens: %s, miss tokens: %s",
+                getattr(usage, "prompt_cache_hit_tokens", None),
+                getattr(usage, "prompt_cache_miss_tokens", None),
+            )
+
+        return {
+            "content": "".join(content),
+            "reasoning_content": "".join(reasoning_content),
+        }
+
+    async def create_completion(self, messages: List[dict], semantic: bool = False) -> dict:
+        """
+        Calls the reasoner, serving identical (or, if semantic is set, similar)
+        requests from the response cache.
+
+        Returns:
+            dict: The assistant "content" and "reasoning_content".
+        """
+        key = self.response_cache.key(messages)
+        pending = self.response_cache.pending(key)
+        try:
+            async with pending:
+                cached = self.response_cache.get(key)
+                if cached is not None:
+                    logger.info("(create_completion) Exact cache hit: %s", key)
+                    return cached
 
-        print((
-            "\n\n------- Reasoning ------\n"
-            f"{reasoning_content}"
-            "------------------------\n\n\n"
-        ))
+                embedding = await self.embed_last_user_turn(messages) if semantic else None
+                if embedding is not None:
+                    similar_key = self.response_cache.nearest(
+                        embedding, self.valves.SEMANTIC_CACHE_THRESHOLD
+                    )
+                    cached = self.response_cache.get(similar_key) if similar_key else None
+                    if cached is not None:
+                        logger.info("(create_completion) Semantic cache hit: %s", similar_key)
+                        return cached
 
-        messages.append({"role": "assistant", "content": assistant_message})
+                result = await self.stream_completion(messages)
+                self.response_cache.set(key, result)
+                if embedding is not None:
+                    self.response_cache.remember(key, embedding)
+                return result
+        finally:
+            self.response_cache.release(key)
 
-        state_result = self.calculate_state(assistant_message)
-        print(f"State Result: {state_result}")
+    async def process_state(self, messages: List[dict], max_depth: Optional[int] = None) -> str:
+        """Process state transitions and messages until a final answer is reached."""
+        # Use the configured MAX_DEPTH from valves if max_depth is not provided
+        max_depth = max_depth if max_depth is not None else self.valves.MAX_DEPTH
+        tool_results: Dict[str, Pipeline.StateResult] = {}
+        last_result = None
+        question = len(messages) - 1
+        for depth in range(max_depth):
+            # Only the opening turn is matched semantically, later turns depend on tool results.
+            response = await self.create_completion(
+                self.compact_messages(messages, question), semantic=depth == 0
+            )
 
-        if state_result.state == self.State.FINISHED:
-            return state_result.message
-        elif state_result.state == self.State.ERROR:
-            messages.append({"role": "user", "content": state_result.message})
-            return self.process_state(messages, max_depth - 1)
-        elif state_result.state == self.State.NEXT_STEP:
-            messages.append({"role": "user", "content": state_result.message})
-            return self.process_state(messages, max_depth - 1)
-        else:
-            return "Unexpected state"
+            assistant_message = response["content"]
+            reasoning_content = response["reasoning_content"]
+
+            print((
+                "\n\n------- Reasoning ------\n"
+                f"{reasoning_content}"
+                "------------------------\n\n\n"
+            ))
+
+            messages.append({"role": "assistant", "content": assistant_message})
+
+            state_result = await self.calculate_state(assistant_message, tool_results)
+            print(f"State Result: {state_result}")
+
+            if state_result.state == self.State.FINISHED:
+                return state_result.message
+            elif state_result.state in (self.State.ERROR, self.State.NEXT_STEP):
+                message = state_result.message
+                match = _RESULT_RE.fullmatch(message)
+                if match and message == last_result:
+                    # the previous, still complete, result already holds this payload
+                    tag = match.group(1)
+                    message = f'<{tag}.result duplicate="true">Identical to the previous {tag} result.</{tag}.result>'
+                elif match:
+                    last_result = message
+                messages.append({"role": "user", "content": message})
+            else:
+                return "Unexpected state"
+
+        return "Max recursion depth exceeded"
 
     def pipe(
         self, user_message: str, model_id: str, messages: List[dict], body: dict
     ) -> Union[str, Generator, Iterator]:
-        """Main pipeline entry point with recursive state handling."""
+        """Main pipeline entry point with iterative state handling."""
         print(f"pipe:{__name__}")
 
-        system_message = {
-            "role": "system",
-            "content": self.SYSTEM_PROMPT.replace("{now}", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-        }
-
-        messages = [system_message] + messages + [
-            {"role": "user", "content": user_message}
+        # The static prompt stays byte-identical across requests so the provider
+        # can reuse its prefix cache, only the short second message changes.
+        system_messages = [
+            self.SYSTEM_MESSAGE,
+            {"role": "system", "content": f"Now is: {datetime.now():%Y-%m-%d %H:%M:%S}"},
         ]
 
-        return self.process_state(messages).strip()
+        # The server already passes the current user turn as the last message.
+        last = messages[-1] if messages else {}
+        if last.get("role") != "user" or last.get("content") != user_message:
+            messages = messages + [{"role": "user", "content": user_message}]
+        messages = system_messages + messages
+
+        return self.run_coroutine(self.process_state(messages)).strip()
+
+# Rendered once at import time and embedded in the static system prompt.
+_TOOL_TAGS_STR = Pipeline.available_tools_tags_generator(Pipeline.AVAILABLE_TOOLS)
+
+# Maps each executable tool tag to its request adapter, executor, result tag,
+# error label and memoize flag, derived from AVAILABLE_TOOLS so the prompt and
+# dispatch never drift.
+_DISPATCH = {
+    tool["function"]: (
+        TypeAdapter(tool["model"]),
+        tool["executor"],
+        f"{tool['function']}.result",
+        tool["label"],
+        tool["memoize"],
+    )
+    for tool in Pipeline.AVAILABLE_TOOLS.values()
+    if "executor" in tool
+}
 
 Pipeline.SYSTEM_PROMPT = (
     "You should help the user to answer the question using the available tools."
-    "Now is: {now}"
     "Your ouput MUST be only a tag based on these available tools:"
-    f"Available tools: {Pipeline.available_tools_tags_generator(Pipeline.AVAILABLE_TOOLS)}"
+    f"Available tools: {_TOOL_TAGS_STR}"
     "MANDATORY: "
     " - Only return one tag per interaction"
     " - If you have source of the information, you must link on the final answer"
@@ -418,4 +1124,7 @@ Pipeline.SYSTEM_PROMPT = (
     " - You must answer using the same language of the question"
     " - Always write the tag <confidence_level></confidence_level> at the end of the answer"
     " - You must only write a final answer when you has a high confidence level"
-)
\ No newline at end of file
+)
+
+# Built once, every request shares the same static system message.
+Pipeline.SYSTEM_MESSAGE = {"role": "system", "content": Pipeline.SYSTEM_PROMPT}
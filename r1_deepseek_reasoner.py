@@ -609,40 +609,40 @@ class Pipeline:
         )
 
     def process_state(self, messages: List[dict], max_depth: int = None) -> str:
-        """Recursively process state transitions and messages."""
+        """Process state transitions and messages until a final answer is reached."""
         # Use the configured MAX_DEPTH from valves if max_depth is not provided
         max_depth = max_depth if max_depth is not None else self.valves.MAX_DEPTH
-        if max_depth <= 0:
-            return "Max recursion depth exceeded"
+        while max_depth > 0:
+            # get all messages after the 0 (System) and concact all together and send as user
 
-        # get all messages after the 0 (System) and concact all together and send as user
+            print("(process_state) messages", messages)
+            response = self.client.chat.completions.create(
+                model="deepseek-reasoner",
+                messages=messages,
+                stream=False
+            )
 
-        print("(process_state) messages", messages)
-        response = self.client.chat.completions.create(
-            model="deepseek-reasoner",
-            messages=messages,
-            stream=False
-        )
+            assistant_message = response.choices[0].message.content
+            reasoning_content = response.choices[0].message.reasoning_content
 
-        assistant_message = response.choices[0].message.content
-        reasoning_content = response.choices[0].message.reasoning_content
+            print((
+                "\n\n------- Reasoning ------\n"
+                f"{reasoning_content}\n"
+                "------------------------\n\n\n"
+            ))
 
-        print((
-            "\n\n------- Reasoning ------\n"
-            f"{reasoning_content}\n"
-            "------------------------\n\n\n"
-        ))
+            messages.append({"role": "assistant", "content": assistant_message})
 
-        messages.append({"role": "assistant", "content": assistant_message})
+            state_result = self.calculate_state(assistant_message)
+            print(f"State Result: {state_result}")
 
-        state_result = self.calculate_state(assistant_message)
-        print(f"State Result: {state_result}")
+            if state_result.state == State.FINISHED:
+                return state_result.message
 
-        if state_result.state == State.FINISHED:
-            return state_result.message
-        else:
             messages.append({"role": "user", "content": state_result.message})
-            return self.process_state(messages, max_depth - 1)
+            max_depth -= 1
+
+        return "Max recursion depth exceeded"
 
     def pipe(
         self, user_message: str, model_id: str, messages: List[dict], body: dict